@@ -0,0 +1,135 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+CHAT_WORKERS = int(os.environ.get('CHAT_WORKERS', 8))
+# Distinct questions only: repeats of a question already being answered are not counted (see ChatPool.run)
+CHAT_MAX_QUEUE = int(os.environ.get('CHAT_MAX_QUEUE', 32))
+# Shed new questions instead of queueing them if a provider asked us to wait longer than this
+MAX_BACKOFF_WAIT = float(os.environ.get('MAX_BACKOFF_WAIT', 20))
+DEFAULT_RETRY_AFTER = 5
+
+
+class Overloaded(Exception):
+    pass
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after=DEFAULT_RETRY_AFTER):
+        super().__init__(f"Rate limited, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def retry_after_seconds(headers, default=DEFAULT_RETRY_AFTER):
+    if headers is None:
+        return default
+    if headers.get('retry-after-ms'):
+        return float(headers['retry-after-ms']) / 1000
+    value = headers.get('retry-after')
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return default
+
+
+class ProviderGate:
+    """Caps concurrent calls to one upstream provider and pauses all of them after a 429."""
+
+    def __init__(self, name, limit, retries=3):
+        self.name = name
+        self.limit = limit
+        self.retries = retries
+        self.semaphore = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.blocked_until = 0
+        self.rate_limited = 0
+
+    def blocked_for(self):
+        return max(0, self.blocked_until - time.time())
+
+    def back_off(self, seconds):
+        with self.lock:
+            self.rate_limited += 1
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+
+    def call(self, fn, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            with self.semaphore:
+                # Re-check inside the semaphore: someone may have been rate limited while we queued
+                time.sleep(self.blocked_for())
+                try:
+                    return fn(*args, **kwargs)
+                except RateLimited as e:
+                    self.back_off(e.retry_after)
+                    print(f"{self.name} rate limited, pausing calls for {e.retry_after}s")
+                    if attempt == self.retries:
+                        raise
+
+    def stats(self):
+        return {'limit': self.limit, 'blocked_for': round(self.blocked_for(), 1), 'rate_limited': self.rate_limited}
+
+
+class ChatPool:
+    """Bounded worker pool for the chat pipeline, shedding load when the queue is full."""
+
+    def __init__(self, workers=CHAT_WORKERS, max_queue=CHAT_MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat')
+        self.pending = 0
+        self.shed = 0
+        # key -> requests running for it, to let repeated questions through
+        self.in_flight = {}
+
+    async def run(self, fn, *args, key=None, **kwargs):
+        # Awaited from the event loop: queued requests hold no threadpool thread, and
+        # pending/in_flight are only touched from the loop thread, so no lock is needed.
+        # A question that is already being answered skips the depth check: the coalescing
+        # flights make it wait for that call instead of reaching the providers again, so
+        # it costs a queue slot but no upstream capacity.
+        repeated = key is not None and self.in_flight.get(key, 0) > 0
+        busy = max(gate.blocked_for() for gate in gates) > MAX_BACKOFF_WAIT
+        if not repeated and (busy or self.pending >= self.workers + self.max_queue):
+            self.shed += 1
+            raise Overloaded()
+        if not repeated:
+            self.pending += 1
+        if key is not None:
+            self.in_flight[key] = self.in_flight.get(key, 0) + 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            if not repeated:
+                self.pending -= 1
+            if key is not None:
+                self.in_flight[key] -= 1
+                if not self.in_flight[key]:
+                    del self.in_flight[key]
+
+    def stats(self):
+        return {'workers': self.workers, 'max_queue': self.max_queue, 'pending': self.pending,
+                'questions': len(self.in_flight), 'shed': self.shed}
+
+
+openai = ProviderGate('openai', int(os.environ.get('OPENAI_CONCURRENCY', 4)))
+jina = ProviderGate('jina', int(os.environ.get('JINA_CONCURRENCY', 4)))
+pinecone = ProviderGate('pinecone', int(os.environ.get('PINECONE_CONCURRENCY', 8)))
+gates = (openai, jina, pinecone)
+
+chat_pool = ChatPool()
+
+
+def stats():
+    data = {gate.name: gate.stats() for gate in gates}
+    data['chat'] = chat_pool.stats()
+    return data
@@ -2,19 +2,38 @@
 import ell
 from pydantic import BaseModel, Field
 from typing import List
+import chat_sessions
+import coalescing
+import admission
+import openai
 from pinecone import Pinecone, ServerlessSpec
 import requests
 import os
+import time
 from dotenv import load_dotenv
 load_dotenv()
 
 
+INDEX_NAME = "mjd-summaries"
+
+# 429s are retried by admission.openai, which pauses every caller; the SDK must not retry them on its own
+try:
+    openai_client = openai.Client(max_retries=0)
+except openai.OpenAIError:
+    openai_client = None  # no API key yet, ell falls back to its default client
+
+
 def get_pinecone_index(index_name: str):
     pc = Pinecone(api_key=os.environ.get('PINECONE_API_KEY'))
     return pc.Index(index_name)
 
 
 def get_jina_embeddings(text):
+    key = coalescing.normalize_question(text)
+    return coalescing.embeddings.do(key, admission.jina.call, request_jina_embeddings, [text])[0]
+
+
+def request_jina_embeddings(texts, task="retrieval.query"):
     url = 'https://api.jina.ai/v1/embeddings'
     headers = {
         'Content-Type': 'application/json',
@@ -23,26 +42,211 @@ def get_jina_embeddings(text):
 
     data = {
         "model": "jina-embeddings-v3",
-        "task": "retrieval.query",
+        "task": task,
         "dimensions": 1024,
         "late_chunking": True,
         "embedding_type": "float",
-        "input": [text]
+        "input": texts
     }
 
     response = requests.post(url, headers=headers, json=data)
-    return response.json()['data'][0]['embedding']
+    if response.status_code == 429:
+        raise admission.RateLimited(admission.retry_after_seconds(response.headers))
+    return [item['embedding'] for item in response.json()['data']]
+
+
+def metadata_filter(course=None, tri=None):
+    conditions = {}
+    if course:
+        conditions['disciplina'] = {"$eq": course}
+    if tri:
+        conditions['tri'] = {"$eq": int(tri)}
+    return conditions or None
+
+
+NAMESPACE_STATS_TTL = 300
+# Namespace holding a single vector, written by partition_index once every vector has been moved
+PARTITION_MARKER = "partitioned"
+partition_state = {'checked': 0, 'done': False}
+
+
+def is_partitioned(index):
+    if not partition_state['done'] and time.time() - partition_state['checked'] > NAMESPACE_STATS_TTL:
+        stats = admission.pinecone.call(index.describe_index_stats)
+        partition_state['done'] = PARTITION_MARKER in stats.namespaces
+        partition_state['checked'] = time.time()
+    return partition_state['done']
+
 
+def turma_namespace(index, turma):
+    """The turma's namespace, or the default one until `python main.py partition` has run."""
+    # Ingestion writes to the same namespace, so nothing is split between the two before the migration
+    if not turma or not is_partitioned(index):
+        return ""
+    return turma
 
-def get_relevante_documents(question, index):
+
+def get_relevante_documents(question, index, top_k=5, turma=None, course=None, tri=None):
+    """Searches only the turma's namespace, with course/trimester filters applied by Pinecone."""
+    namespace = turma_namespace(index, turma)
+    query_filter = metadata_filter(course, tri)
+    key = (coalescing.normalize_question(question), top_k, namespace, str(query_filter))
+    return coalescing.retrieval.do(key, query_index, question, index, top_k, namespace, query_filter)
+
+
+def query_index(question, index, top_k, namespace="", query_filter=None):
     question_embedding = get_jina_embeddings(question)
-    results = index.query(
+    results = admission.pinecone.call(
+        index.query,
         vector=question_embedding,
-        top_k=5,  # Return top 5 results
+        top_k=top_k,
+        namespace=namespace,
+        filter=query_filter,
         include_metadata=True
     )
     return results.matches
 
+
+def block_metadata(recording, course, block):
+    return {
+        'recording_id': str(recording['recording_id']),
+        'disciplina': course['nome'],
+        'title': recording['ai_summary']['title'],
+        'data_str': recording['data_str'],
+        'text': block['block'],
+        'start': block['start'],
+        'turma': course['turma'],
+        'tri': course.get('tri', 0),
+    }
+
+
+def upsert_class_blocks(index, recording, course):
+    """Embeds the summary blocks of a recording into its turma's namespace, replacing the ones already there."""
+    blocks = recording['ai_summary']['blocks']
+    if not blocks:
+        return 0
+    embeddings = admission.jina.call(request_jina_embeddings, [b['block'] for b in blocks], "retrieval.passage")
+    namespace = turma_namespace(index, course['turma'])
+    # Looked up by metadata, since vectors migrated by partition_index may have other ids
+    # (serverless indexes can't delete by filter)
+    existing = admission.pinecone.call(index.query, vector=embeddings[0], top_k=1000, namespace=namespace,
+                                       filter={"recording_id": {"$eq": str(recording['recording_id'])}})
+    vectors = [{
+        'id': f"{recording['recording_id']}-{i}",
+        'values': embedding,
+        'metadata': block_metadata(recording, course, block),
+    } for i, (block, embedding) in enumerate(zip(blocks, embeddings))]
+    index.upsert(vectors=vectors, namespace=namespace)
+    # Deleted after the upsert so the recording never disappears from the index in between
+    stale = {match.id for match in existing.matches} - {vector['id'] for vector in vectors}
+    if stale:
+        index.delete(ids=list(stale), namespace=namespace)
+    return len(vectors)
+
+
+def partition_index(index, db, batch_size=100):
+    """Moves vectors from the default namespace into per-turma namespaces (one-off migration)."""
+    turmas = {c['zoom_id']: c for c in db.disciplinas.find()}
+    recordings = {str(r['recording_id']): turmas.get(r['meeting_id']) for r in db.gravacoes.find({}, {"recording_id": 1, "meeting_id": 1})}
+    moved = 0
+    unresolved = []
+    # Listed up front, since vectors are deleted from this namespace as they move
+    ids = [vector_id for page in index.list(namespace="") for vector_id in page]
+    for start in range(0, len(ids), batch_size):
+        fetched = index.fetch(ids=ids[start:start + batch_size], namespace="").vectors
+        by_turma = {}
+        for vector_id, vector in fetched.items():
+            course = recordings.get(str((vector.metadata or {}).get('recording_id')))
+            if not course:
+                unresolved.append(vector_id)
+                continue
+            metadata = {**vector.metadata, 'turma': course['turma'], 'tri': course.get('tri', 0)}
+            by_turma.setdefault(course['turma'], []).append({'id': vector_id, 'values': vector.values, 'metadata': metadata})
+        for turma, vectors in by_turma.items():
+            index.upsert(vectors=vectors, namespace=turma)
+            index.delete(ids=[v['id'] for v in vectors], namespace="")
+            moved += len(vectors)
+    print(f"{moved} vectors moved to turma namespaces")
+    if unresolved:
+        # Left in the default namespace, only reachable by queries without a turma
+        print(f"{len(unresolved)} vectors without a known recording stayed in the default namespace: {unresolved}")
+    dimension = index.describe_index_stats().dimension
+    index.upsert(vectors=[{'id': PARTITION_MARKER, 'values': [1.0] + [0.0] * (dimension - 1)}], namespace=PARTITION_MARKER)
+    partition_state['checked'] = 0
+    return moved
+
+
+## CONTEXT ASSEMBLY
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 1200))
+# Follow-ups mostly refer to the previous answer, so they get a smaller context
+FOLLOW_UP_TOKEN_BUDGET = int(os.environ.get('FOLLOW_UP_TOKEN_BUDGET', CONTEXT_TOKEN_BUDGET // 2))
+CONTEXT_MIN_SCORE = float(os.environ.get('CONTEXT_MIN_SCORE', 0.3))
+SIMPLE_QUESTION_MAX_WORDS = int(os.environ.get('SIMPLE_QUESTION_MAX_WORDS', 12))
+
+# Words that usually mean the student wants an explanation, not a lookup
+COMPLEX_QUESTION_WORDS = ("explique", "explica", "compare", "diferença", "por que", "porque", "como funciona", "relação")
+
+
+def estimate_tokens(text):
+    # Roughly 4 characters per token for gpt-4o, good enough for budgeting
+    return len(text) // 4 + 1
+
+
+def merge_matches(matches, min_score=CONTEXT_MIN_SCORE):
+    """Groups the Pinecone matches by recording, dropping low scores and repeated texts."""
+    recordings = {}
+    for match in matches:
+        if match.score < min_score:
+            continue
+        metadata = match.metadata or {}
+        key = str(metadata.get('recording_id') or f"{metadata.get('disciplina')}|{metadata.get('data_str')}")
+        recording = recordings.setdefault(key, {
+            'key': key,
+            'disciplina': metadata.get('disciplina', ''),
+            'title': metadata.get('title', ''),
+            'data_str': metadata.get('data_str', ''),
+            'score': match.score,
+            'texts': []
+        })
+        recording['score'] = max(recording['score'], match.score)
+        text = ' '.join(str(metadata.get('text', '')).split())
+        if metadata.get('start'):
+            text = f"[{metadata['start']}] {text}"
+        if text and text not in recording['texts']:
+            recording['texts'].append(text)
+    return sorted(recordings.values(), key=lambda r: r['score'], reverse=True)
+
+
+def render_context(recordings, max_tokens=CONTEXT_TOKEN_BUDGET):
+    lines = []
+    used = 0
+    for recording in recordings:
+        header = f"{recording['disciplina']} | {recording['title']} | {recording['data_str']}:"
+        for text in recording['texts']:
+            line = f"{header} {text}"
+            tokens = estimate_tokens(line)
+            if used + tokens > max_tokens:
+                if lines:
+                    return '\n'.join(lines)
+                # Always send something, even if the best match is too long
+                line = line[:max_tokens * 4]
+                tokens = max_tokens
+            lines.append(line)
+            used += tokens
+    return '\n'.join(lines)
+
+
+def build_context(matches, max_tokens=CONTEXT_TOKEN_BUDGET, min_score=CONTEXT_MIN_SCORE):
+    return render_context(merge_matches(matches, min_score), max_tokens)
+
+
+def is_simple_question(question):
+    words = question.lower().split()
+    if len(words) > SIMPLE_QUESTION_MAX_WORDS:
+        return False
+    return not any(word in question.lower() for word in COMPLEX_QUESTION_WORDS)
+
+
 class ClassInfo(BaseModel):
     course: str = Field(description="O nome da disciplina")
     class_name: str = Field(description="O nome da aula")
@@ -53,8 +257,8 @@ class Answer(BaseModel):
     sources: List[ClassInfo] = Field(description="Uma lista de dados relevantes dos trechos das aulas que foram usados para responder à pergunta")
 
 
-@ell.complex(model="gpt-4o", response_format=Answer)
-def get_answer(question, relevant_docs):
+@ell.complex(model="gpt-4o", response_format=Answer, client=openai_client)
+def get_answer(question, relevant_docs, history=""):
     """""
 Crie uma resposta para perguntas de estudantes usando documentos do curso e metadados para determinar se os tópicos foram cobertos e forneça informações relevantes das aulas.
 
@@ -109,10 +313,74 @@ Forneça a resposta em formato de parágrafo estruturado:
   - Sim, a disciplina de Ética em Jornalismo de Dados teve uma entrevista com a jornalista da Folha de S. Paulo na Lição 5. Durante essa sessão, o jornalista discutiu o impacto das tecnologias digitais no jornalismo moderno, incluindo a transição do impresso para o digital e os desafios contemporâneos enfrentados pelas redações, como a disseminação de fake news e a importância da verificação de fatos.
   - A entrevista também abordou a evolução das técnicas de reportagem diante das mudanças tecnológicas e a adaptação dos jornalistas ao uso de ferramentas de análise de dados para investigações mais aprofundadas. Os alunos tiveram a oportunidade de aprender sobre a ética no jornalismo digital e como as publicações tradicionais estão se reinventando para permanecerem relevantes na era digital.
     """
-    return f"Responda a pergunta {question}, usando os documentos relevantes como base:{relevant_docs}. Utilize markdown para formatar a resposta."
+    return f"{history_block(history)}Responda a pergunta {question}, usando os documentos relevantes como base:\n{relevant_docs}\nUtilize markdown para formatar a resposta."
+
+
+@ell.complex(model="gpt-4o-mini", response_format=Answer, client=openai_client)
+def get_short_answer(question, relevant_docs, history=""):
+    """Você responde perguntas de estudantes sobre as aulas do curso. Use apenas os trechos recebidos (disciplina | aula | data: conteúdo) para dizer em qual disciplina e aula o tópico foi abordado e resuma o que foi visto, dirigindo-se ao aluno. Se o tópico não aparecer nos trechos, diga isso."""
+    return f"{history_block(history)}Responda a pergunta {question}, usando os documentos relevantes como base:\n{relevant_docs}\nUtilize markdown para formatar a resposta."
+
+
+@ell.simple(model="gpt-4o-mini", client=openai_client)
+def summarize_history(summary, turns):
+    """Você resume conversas entre um aluno e o bot do curso em poucas frases, mantendo as disciplinas, aulas e datas citadas."""
+    return f"Resumo anterior: {summary}\nNovas mensagens: {turns}\nAtualize o resumo."
+
+
+def call_openai(fn, *args):
+    try:
+        return fn(*args)
+    except openai.RateLimitError as e:
+        raise admission.RateLimited(admission.retry_after_seconds(e.response.headers))
+
+
+def history_block(history):
+    if not history:
+        return ""
+    return f"Conversa até aqui:\n{history}\n\n"
+
 
+def compact_history(session):
+    if len(session['history']) <= chat_sessions.HISTORY_MAX_TURNS:
+        return
+    keep = chat_sessions.HISTORY_MAX_TURNS // 2
+    old_turns = session['history'][:-keep]
+    turns = '\n'.join(f"Aluno: {t['q']}\nBot: {t['a']}" for t in old_turns)
+    session['summary'] = admission.openai.call(call_openai, summarize_history, session['summary'], turns)
+    session['history'] = session['history'][-keep:]
 
-def process_message(message):
-    relevant_docs = get_relevante_documents(message, get_pinecone_index("mjd-summaries"))
-    return get_answer(message, relevant_docs)
 
+def process_message(message, session=None, turma=None, course=None, tri=None):
+    session = session or chat_sessions.new_session(chat_sessions.new_session_id())
+    chat_sessions.set_scope(session, {'turma': turma, 'course': course, 'tri': tri})
+    if chat_sessions.is_follow_up(message, session):
+        budget = FOLLOW_UP_TOKEN_BUDGET
+        # Follow-ups keep what was already retrieved, and only search again if it doesn't fill the budget
+        if estimate_tokens(render_context(session['recordings'])) >= budget:
+            query, top_k = None, 0
+        else:
+            query, top_k = chat_sessions.follow_up_query(message, session), chat_sessions.FOLLOW_UP_TOP_K
+    else:
+        budget = CONTEXT_TOKEN_BUDGET
+        query, top_k = message, 5
+    matches = []
+    if query:
+        matches = get_relevante_documents(query, get_pinecone_index(INDEX_NAME), top_k=top_k, turma=turma, course=course, tri=tri)
+    recordings = chat_sessions.extend_recordings(session, merge_matches(matches))
+    relevant_docs = render_context(recordings, budget)
+    history = chat_sessions.history_prompt(session)
+    context_tokens = estimate_tokens(relevant_docs)
+    # Reused follow-ups are compared with what the full context would have cost
+    raw_tokens = estimate_tokens(str(matches)) if matches else estimate_tokens(render_context(recordings))
+    if is_simple_question(message):
+        model, generate = "gpt-4o-mini", get_short_answer
+    else:
+        model, generate = "gpt-4o", get_answer
+    key = (model, coalescing.normalize_question(message), relevant_docs, history)
+    answer = coalescing.answers.do(key, admission.openai.call, call_openai, generate, message, relevant_docs, history)
+    retrieval = "full" if budget == CONTEXT_TOKEN_BUDGET else ("follow-up" if matches else "reused")
+    print(f"Context: {context_tokens} tokens (raw matches: {raw_tokens}, saved {raw_tokens - context_tokens}, {retrieval}) - {model}")
+    chat_sessions.add_turn(session, message, answer.parsed.answer)
+    compact_history(session)
+    return answer
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import re
+import requests
+from fasthtml.common import Link, Script
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+VENDOR_DIR = 'vendor'
+# Serve the client-side JS/CSS from our own /assets instead of the CDN (after `python main.py vendor`)
+SELF_HOST_JS = bool(os.environ.get('SELF_HOST_JS'))
+IMMUTABLE = 'public, max-age=31536000, immutable'
+CDN_URL = re.compile(r'https://cdn\.jsdelivr\.net/[^\s"\'()]+')
+CSS_URL = re.compile(r'url\(["\']?([^"\')]+)["\']?\)')
+
+fingerprints = {}
+
+
+def static_file(path):
+    """Absolute path of a file under static/, or None if it is missing or outside the folder."""
+    filename = os.path.normpath(os.path.join(STATIC_DIR, path))
+    if not filename.startswith(STATIC_DIR + os.sep) or not os.path.isfile(filename):
+        return None
+    return filename
+
+
+def fingerprint(path):
+    if path not in fingerprints:
+        with open(static_file(path), 'rb') as f:
+            fingerprints[path] = hashlib.sha256(f.read()).hexdigest()[:12]
+    return fingerprints[path]
+
+
+def asset_url(path):
+    return f"/assets/{fingerprint(path)}/{path}"
+
+
+def static_route_last(app):
+    """Moves fast_app's catch-all /{fname:path}.{ext:static} route after the others."""
+    # It is registered first and would otherwise answer /assets/<digest>/... with a 404
+    app.router.routes.sort(key=lambda route: getattr(route, 'path', '').startswith('/{fname:path}.'))
+
+
+def check_assets(app, paths):
+    """Fails loudly if a fingerprinted asset URL doesn't come back as an immutable 200."""
+    from starlette.testclient import TestClient
+    client = TestClient(app)
+    for path in paths:
+        response = client.get(asset_url(path))
+        if response.status_code != 200 or 'immutable' not in response.headers.get('cache-control', ''):
+            raise Exception(f"{asset_url(path)} returned {response.status_code}, {response.headers.get('cache-control')}")
+
+
+def vendor_path(url):
+    return f"{VENDOR_DIR}/{url.split('://', 1)[1].split('/', 1)[1]}"
+
+
+def local_url(url):
+    path = vendor_path(url)
+    return asset_url(path) if static_file(path) else url
+
+
+def flatten(hdrs):
+    for hdr in hdrs:
+        if isinstance(hdr, (list, tuple)):
+            yield from flatten(hdr)
+        else:
+            yield hdr
+
+
+def cdn_urls(hdr):
+    urls = [v for v in hdr.attrs.values() if isinstance(v, str) and CDN_URL.fullmatch(v)]
+    for child in hdr.children:
+        urls += CDN_URL.findall(str(child))
+    return urls
+
+
+def self_hosted(hdrs):
+    """Rewrites the CDN scripts and stylesheets in hdrs to their vendored copies."""
+    local = []
+    for hdr in flatten(hdrs):
+        if hdr.tag == 'script' and hdr.attrs.get('src'):
+            hdr = Script(**{**hdr.attrs, 'src': local_url(hdr.attrs['src'])})
+        elif hdr.tag == 'script':
+            code = CDN_URL.sub(lambda m: local_url(m.group(0)), ''.join(str(c) for c in hdr.children))
+            hdr = Script(code, **hdr.attrs)
+        elif hdr.tag == 'link' and hdr.attrs.get('href'):
+            hdr = Link(**{**hdr.attrs, 'href': local_url(hdr.attrs['href'])})
+        local.append(hdr)
+    return local
+
+
+def download(url):
+    filename = os.path.join(STATIC_DIR, vendor_path(url))
+    response = requests.get(url)
+    response.raise_for_status()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wb') as f:
+        f.write(response.content)
+    print(f"{url} -> {filename}")
+    if url.endswith('.css'):
+        # Fonts and images referenced by the stylesheet, relative to it
+        base = url.rsplit('/', 1)[0]
+        for ref in set(CSS_URL.findall(response.text)):
+            if not ref.startswith(('data:', 'http')):
+                download(f"{base}/{ref}")
+
+
+def vendor(hdrs):
+    """Downloads every CDN file referenced by hdrs into static/vendor."""
+    for hdr in flatten(hdrs):
+        for url in cdn_urls(hdr):
+            download(url)
@@ -0,0 +1,120 @@
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+SESSION_TTL = int(os.environ.get('CHAT_SESSION_TTL', 30 * 60))
+MAX_SESSIONS = int(os.environ.get('CHAT_MAX_SESSIONS', 1000))
+MAX_SESSION_RECORDINGS = int(os.environ.get('CHAT_MAX_SESSION_RECORDINGS', 8))
+HISTORY_MAX_TURNS = int(os.environ.get('CHAT_HISTORY_MAX_TURNS', 4))
+
+# Short questions starting like these usually refer to the previous answer
+FOLLOW_UP_STARTS = ("e ", "e,", "mas ", "então", "entao", "e sobre", "mais ")
+FOLLOW_UP_WORDS = ("seguinte", "anterior", "próxima", "proxima", "essa", "esse", "isso", "dela", "dele", "nela", "nele")
+FOLLOW_UP_MAX_WORDS = 10
+FOLLOW_UP_TOP_K = int(os.environ.get('CHAT_FOLLOW_UP_TOP_K', 2))
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+def new_session(session_id):
+    return {'_id': session_id, 'history': [], 'summary': '', 'recordings': [], 'updated': time.time()}
+
+
+class SessionStore:
+    """In-memory chat sessions with TTL/LRU eviction, optionally backed by a Mongo collection."""
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS, collection=None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.collection = collection
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id):
+        with self.lock:
+            self._evict()
+            session = self.sessions.get(session_id)
+            if session:
+                self.sessions.move_to_end(session_id)
+                return session
+        if self.collection is not None:
+            session = self.collection.find_one({"_id": session_id, "updated": {"$gt": time.time() - self.ttl}})
+        session = session or new_session(session_id)
+        with self.lock:
+            self.sessions[session_id] = session
+        return session
+
+    def save(self, session):
+        session['updated'] = time.time()
+        with self.lock:
+            self.sessions[session['_id']] = session
+            self.sessions.move_to_end(session['_id'])
+            self._evict()
+        if self.collection is not None:
+            self.collection.replace_one({"_id": session['_id']}, session, upsert=True)
+
+    def _evict(self):
+        expired = time.time() - self.ttl
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if session['updated'] > expired and len(self.sessions) <= self.max_sessions:
+                break
+            del self.sessions[session_id]
+
+
+def is_follow_up(question, session):
+    if not session['recordings']:
+        return False
+    text = question.lower().strip()
+    # \w+ so punctuation doesn't stick to the words ("seguinte?")
+    words = re.findall(r'\w+', text)
+    if len(words) > FOLLOW_UP_MAX_WORDS:
+        return False
+    return text.startswith(FOLLOW_UP_STARTS) or any(word in words for word in FOLLOW_UP_WORDS)
+
+
+def follow_up_query(question, session):
+    """The follow-up on its own ("e na aula seguinte?") says little, so search it with the previous topic."""
+    previous = session['history'][-1]['q'] if session['history'] else session['summary']
+    return f"{previous} {question}".strip()
+
+
+def set_scope(session, scope):
+    # Documents retrieved for another turma/course are not valid context anymore
+    if session.get('scope') != scope:
+        session['recordings'] = []
+        session['scope'] = scope
+
+
+def extend_recordings(session, recordings):
+    """Merges newly retrieved recordings into the ones already in the session."""
+    by_key = {r['key']: r for r in session['recordings']}
+    for recording in recordings:
+        existing = by_key.get(recording['key'])
+        if existing:
+            existing['score'] = max(existing['score'], recording['score'])
+            existing['texts'] += [t for t in recording['texts'] if t not in existing['texts']]
+        else:
+            by_key[recording['key']] = recording
+    merged = sorted(by_key.values(), key=lambda r: r['score'], reverse=True)
+    session['recordings'] = merged[:MAX_SESSION_RECORDINGS]
+    return session['recordings']
+
+
+def add_turn(session, question, answer):
+    session['history'].append({'q': question, 'a': answer})
+
+
+def history_prompt(session, answer_chars=400):
+    lines = []
+    if session['summary']:
+        lines.append(f"Resumo da conversa: {session['summary']}")
+    for turn in session['history']:
+        lines.append(f"Aluno: {turn['q']}")
+        lines.append(f"Bot: {turn['a'][:answer_chars]}")
+    return '\n'.join(lines)
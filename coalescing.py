@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+
+# Keep results this long after a call finishes, for identical questions arriving just after it
+COALESCE_LINGER = float(os.environ.get('COALESCE_LINGER', 5))
+
+
+def normalize_question(question):
+    return ' '.join(question.lower().split()).strip(' ?!.')
+
+
+class SingleFlight:
+    """Runs one call per key at a time; concurrent callers with the same key wait and share its result."""
+
+    def __init__(self, name, linger=COALESCE_LINGER):
+        self.name = name
+        self.linger = linger
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.recent = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            recent = self.recent.get(key)
+            if recent and recent[0] > time.time():
+                self.coalesced += 1
+                return recent[1]
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'done': threading.Event(), 'result': None, 'error': None}
+                self.calls[key] = call
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = fn(*args, **kwargs)
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+                now = time.time()
+                self.recent = {k: r for k, r in self.recent.items() if r[0] > now}
+                if call['error'] is None and self.linger:
+                    self.recent[key] = (now + self.linger, call['result'])
+            call['done'].set()
+
+    def stats(self):
+        return {'executed': self.executed, 'coalesced': self.coalesced, 'in_flight': len(self.calls)}
+
+
+embeddings = SingleFlight('embedding')
+retrieval = SingleFlight('retrieval')
+answers = SingleFlight('llm')
+
+
+def stats():
+    return {flight.name: flight.stats() for flight in (embeddings, retrieval, answers)}
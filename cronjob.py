@@ -10,6 +10,8 @@ from pymongo import MongoClient
 import time
 import arrow
 import boto3
+from prerender import rebuild_static_site
+from transcripts import store_transcript
 from dotenv import load_dotenv, find_dotenv
 load_dotenv(find_dotenv())
 
@@ -111,8 +113,7 @@ def get_meeting_info(client, meeting_id, token):
     if len(transcricao_list) == 0:
         obj['transcription'] = None
     else:
-        obj['transcription'] = f"{transcricao_list[0]
-                                  ['download_url']}?access_token={token}"
+        obj['transcription'] = transcricao_list[0]['download_url']
     obj['psw'] = dados['password']
     obj['meeting_id'] = meeting_id
     obj['recording_id'] = files[0]['id']
@@ -202,6 +203,7 @@ def adicionar_disciplina(nome="Datavis Studio II", zoom_id=91739934274, turma="M
     db.disciplinas.insert_one({"finalizada": False, 'nome': nome,
                                "turma": turma, "zoom_id": zoom_id,
                                "channel": "5-tri-interfaces-narrativas-para-web"})
+    rebuild_static_site()
 
 
 def split_markdown(markdown_str, chunk_size=2000):
@@ -221,6 +223,7 @@ if __name__ == '__main__':
     db = initiate_mongo_db()
     zoom_client = initiate_zoom_app()
     # slack_client = WebClient(token=os.environ.get("SLACK_BOT_TOKEN"))
+    novas_gravacoes = 0
     for x in db.disciplinas.find({"finalizada": False}):
         last = get_meeting_info(zoom_client[0], x['zoom_id'], zoom_client[1])
         if db.gravacoes.find_one({"recording_id": last['recording_id']}):
@@ -228,6 +231,9 @@ if __name__ == '__main__':
             continue
         else:
             print("Acrescentando gravação")
+            novas_gravacoes += 1
+            # Downloaded right away, while the token is fresh, and kept for later use
+            store_transcript(db, last['recording_id'], last['transcription'], zoom_client[1])
             if x['turma'] == 'MJD002':
                 slack_client = WebClient(
                     token=os.environ.get("SLACK_BOT_TOKEN22"))
@@ -275,3 +281,6 @@ if __name__ == '__main__':
                 #    msg_nova_transcricao(markdown, slack_client, channel=x['channel'])
                 # last.update({"markdown": markdown})
                 db.gravacoes.insert_one(last)
+    if novas_gravacoes:
+        print("Atualizando páginas estáticas")
+        rebuild_static_site()
@@ -1,9 +1,22 @@
 from fasthtml.common import *
-from ai_helpers import process_message
+from ai_helpers import process_message, partition_index, get_pinecone_index, INDEX_NAME
+from chat_sessions import SessionStore, new_session_id
+from summaries import resummarize_recording
+import coalescing
+import admission
+from search_index import SearchIndex
+from prerender import PrerenderMiddleware, export_site
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import FileResponse
+import assets
+from transcripts import load_transcript, said_at
+from timestamps import ms_to_timestamp
 from pymongo import MongoClient
 from dotenv import load_dotenv
 from bson.objectid import ObjectId
 import os
+import sys
 
 load_dotenv()
 
@@ -12,13 +25,21 @@ psw = os.environ.get('MONGODB_PSW')
 mongo_uri = os.environ.get('MONGODB_URI')
 db = MongoClient(f'mongodb://{user}:{psw}@{mongo_uri}/mjd?ssl=true', ssl=True, tlsAllowInvalidCertificates=True).mjd
 
-chatbot_css = Link(rel='stylesheet', href='/static/css/custom.css', type='text/css')
-app, rt = fast_app(hdrs=[chatbot_css, KatexMarkdownJS()])
+TURMA = "MJD003"
+
+chatbot_css = Link(rel='stylesheet', href=assets.asset_url('css/custom.css'), type='text/css')
+search = SearchIndex()
+# Pre-rendered pages are already compressed, so they are served before the gzip middleware
+app, rt = fast_app(hdrs=[chatbot_css, KatexMarkdownJS()], on_startup=[lambda: search.refresh(db)],
+                   middleware=[Middleware(PrerenderMiddleware), Middleware(GZipMiddleware, minimum_size=500)])
+if assets.SELF_HOST_JS:
+    app.hdrs = assets.self_hosted(app.hdrs)
+chat_store = SessionStore(collection=db.chat_sessions if os.environ.get('CHAT_SESSIONS_MONGO') else None)
 
 # Home Page
 @rt("/")
 def home():
-    courses = db.disciplinas.find({"turma": "MJD003"}).sort("tri", -1)
+    courses = db.disciplinas.find({"turma": TURMA}).sort("tri", -1)
     courses_by_tri = {}
     for course in courses:
         tri = course['tri']
@@ -30,6 +51,10 @@ def home():
                   P("Clique no nome da disciplina para acessar as gravações das aulas ou use o chat ao lado para fazer perguntas sobre quando e como quais assuntos foram abordados nas aulas."),
                   Div(
                       Div(
+                          Input(type="search", name="q", placeholder="Em que aula vimos...? Digite para buscar",
+                                hx_get="/search", hx_trigger="input changed delay:300ms, search",
+                                hx_target="#search-results", hx_vals=f'{{"turma": "{TURMA}"}}'),
+                          Div(id="search-results"),
                           *[Card(
                               H3(f"{tri}º trimestre"),
                               Ul(*[Li(A(course["nome"], href=f"/courses/{course['zoom_id']}")) for course in courses_by_tri[tri]])
@@ -41,6 +66,7 @@ def home():
                           Div(id="chat-messages"),
                           Form(
                               Input(type="text", name="message", placeholder="Faça sua pergunta e aperte Enter...", cls="input-message"),
+                              Hidden(name="turma", value=TURMA),
                               Button(
                                   "Processando...", type="submit", cls="button-send secondary htmx-indicator", aria_busy="true", aria_label="Please wait…", id='loading'),
                               hx_post="/send-message",
@@ -65,24 +91,80 @@ def course_page(course_id: int):
                   *[class_card(recording, i) for i, recording in enumerate(classes, 1)])
 
 
+def answer_message(message, chat_id, turma, course, tri):
+    chat = chat_store.get(chat_id)
+    answer = process_message(message, chat, turma, course, tri)
+    chat_store.save(chat)
+    return answer
+
+
+# Async so that queued questions wait on the chat pool, not on Starlette's threadpool
 @rt("/send-message")
-def post(message: str):
-    answer = process_message(message)
+async def post(message: str, session, turma: str = None, course: str = None, tri: int = None):
+    chat_id = session.setdefault('chat_id', new_session_id())
+    try:
+        key = (coalescing.normalize_question(message), turma, course, tri)
+        answer = await admission.chat_pool.run(answer_message, message, chat_id, turma, course, tri, key=key)
+    except (admission.Overloaded, admission.RateLimited):
+        return P("O bot está recebendo muitas perguntas agora. Tente novamente em instantes.", cls="chat-busy")
     return P(answer.parsed.answer, cls="marked")
 
 
+@rt("/search")
+def get(q: str = "", turma: str = None):
+    search.maybe_refresh(db)
+    if len(q.strip()) < 2:
+        return ""
+    hits = search.search(q, turma=turma)
+    if not hits:
+        return P("Nenhum trecho encontrado.", cls="search-empty")
+    return Ul(*[search_hit(hit) for hit in hits], cls="search-results")
+
+
+def search_hit(hit):
+    label = f"{hit['course']} ({hit['date']}) - {hit['start']}"
+    return Li(A(label, href=hit['link'], target="_blank") if hit['link'] else Strong(label),
+              P(hit['text'][:200], cls="search-snippet"))
+
+
+@rt("/assets/{digest}/{fname:path}")
+def get(digest: str, fname: str):
+    filename = assets.static_file(fname)
+    if not filename:
+        return Response(status_code=404)
+    # Stale digests (e.g. from an old cached page) still get the file, just not cached forever
+    cache = assets.IMMUTABLE if digest == assets.fingerprint(fname) else 'public, max-age=3600'
+    return FileResponse(filename, headers={'Cache-Control': cache})
+
+assets.static_route_last(app)
+
+
+@rt("/stats")
+def stats():
+    return {"coalescing": coalescing.stats(), "admission": admission.stats()}
+
+
 @rt("/expand/{recording_id}")
 def get_summary(recording_id: str):
     recording = db.gravacoes.find_one({"_id": ObjectId(recording_id)})
     return P(f"({recording['data_str']}) {recording['ai_summary']['summary']}"),\
            Ul(*[Li(f"{block['start']} - {block['block']}") for block in recording["ai_summary"]['blocks']])
 
+@rt("/transcript/{recording_id}")
+def get(recording_id: str, t: str = "00:00:00"):
+    recording = db.gravacoes.find_one({"_id": ObjectId(recording_id)})
+    transcript = load_transcript(db, recording['recording_id'])
+    if transcript is None:
+        return P("Transcrição indisponível para esta aula.")
+    return Ul(*[Li(f"{ms_to_timestamp(start)} - {text}") for start, text in said_at(transcript, t)])
+
+
 def class_card(recording: dict, i: int):
     return Card(
         H3(f"{i}. {recording['ai_summary']['title']}"),
         P(
             A(href=recording['download_url'], target="_blank", title="Download recording")
-          (Img(src="/static/img/download_button.svg", alt="download icon", width="32", height="32", cls="w-4 h-4"),
+          (Img(src=assets.asset_url('img/download_button.svg'), alt="download icon", width="32", height="32", cls="w-4 h-4"),
            ),
            Div("➕ Detalhes", hx_get=f"/expand/{recording['_id']}", hx_target=f"#summary-{recording['_id']}", hx_swap="innerHTML")
         ),
@@ -90,5 +172,27 @@ def class_card(recording: dict, i: int):
     )
 
 
-# Serve the app
-serve()
\ No newline at end of file
+def export_static():
+    # The exported pages link to these, so make sure they resolve before writing anything
+    assets.check_assets(app, ['css/custom.css', 'img/download_button.svg'])
+    paths = ["/"]
+    for course in db.disciplinas.find():
+        paths.append(f"/courses/{course['zoom_id']}")
+        paths += [f"/expand/{r['_id']}" for r in db.gravacoes.find({"meeting_id": course['zoom_id'], "ai_summary": {"$exists": True}}, {"_id": 1})]
+    export_site(app, paths)
+
+
+# `python main.py export` pre-renders the catalog and course pages,
+# `python main.py vendor` downloads the CDN scripts for SELF_HOST_JS,
+# `python main.py partition` moves the Pinecone vectors into per-turma namespaces,
+# `python main.py resummarize <recording_id>` rewrites a summary from the stored transcript, otherwise serve the app
+if 'export' in sys.argv[1:]:
+    export_static()
+elif 'vendor' in sys.argv[1:]:
+    assets.vendor(app.hdrs)
+elif 'partition' in sys.argv[1:]:
+    partition_index(get_pinecone_index(INDEX_NAME), db)
+elif sys.argv[1:2] == ['resummarize']:
+    resummarize_recording(db, sys.argv[2])
+else:
+    serve()
\ No newline at end of file
@@ -1,4 +1,5 @@
 import re
+from datetime import datetime, timezone
 import time
 from operator import itemgetter
 from unidecode import unidecode
@@ -9,57 +10,16 @@ import base64
 from pyzoom import ZoomClient
 import boto3
 import arrow
+from prerender import rebuild_static_site
+from ai_helpers import INDEX_NAME, get_pinecone_index, upsert_class_blocks
+from transcripts import store_transcript
+from summaries import summarize_transcript
 from dotenv import load_dotenv
 import os
-from pydantic import BaseModel, Field
-import ell
-from typing import List
 
 load_dotenv()
 
 
-## AI STUFF
-class Block(BaseModel):
-    block: str = Field(description="Os temas e conceitos que foram abordados neste trecho da aula, em bullet points. Seja específico sobre todos os conceitos e conteúdos.")
-    start: str = Field(description="O tempo de início deste trecho no formato HH:MM:SS.MS")
-
-
-class Summary(BaseModel):
-    summary: str = Field(description="Um resumo em um parágrafo sobre o que foi abordado na aula")
-    blocks: List[Block] = Field(description="Uma lista de trechos da aula, cada um com os assuntos abordados, e o tempo correspondente no vídeo. O foco deve ser exclusivamente o conteúdo da aula, e não na descrição do que aconteceu.")
-    
-    
-class FinalSummary(BaseModel):
-    summary: str = Field(description="Um resumo em um parágrafo sobre o que foi abordado na aula")
-    title: str = Field(description="Um título para a aula, com breve lista de conceitos mais importantesentre parênteses")
-
-    
-
-@ell.complex(model="gpt-4o", response_format=FinalSummary)
-def fix_class_summary(blocks: List[Block], disciplina: str) -> FinalSummary:
-    """Você é um professor assistente que recebe um resumo estruturado de uma aula e corrige possíveis erros de formatação, sem alterar o conteúdo."""
-    return f"Leia a seguinte lista de trechos de uma aula da disciplina {disciplina}. Crie um título para a aula, dentro do contexto da disciplina, e um resumo em um parágrafo sobre o que foi abordado: {blocks}"
-
-
-@ell.complex(model="gpt-4o-mini", response_format=Summary)
-def generate_class_summary(transcription: str) -> Summary:
-    """Você é um professor assistente que recebe a transcrição de uma aula e gera um resumo estruturado com o conteúdo abordado."""
-    return f"Gere um resumo da seguinte aula: {transcription}"
-
-
-def parse_summary(summary):
-    data = {}
-    parsed = summary.content[0].parsed
-    data['summary'] = parsed.summary
-    data['blocks'] = []
-    for block in parsed.blocks:
-        data['blocks'].append({
-            'block': block.block,
-            'start': block.start
-        })
-    return data
-
-
 ## DATABASE AND ZOOM STUFF
 def initiate_mongo_db():
     user = os.environ.get('MONGODB_USER')
@@ -123,7 +83,8 @@ def get_meeting_info(client, meeting_id, token):
     if len(transcricao_list) == 0:
         obj['transcription'] = None
     else:
-        obj['transcription'] = f"{transcricao_list[0]['download_url']}?access_token={token}"
+        # Stored without the access token, which expires; see transcripts.download_transcript
+        obj['transcription'] = transcricao_list[0]['download_url']
     obj['psw'] = dados['password']
     obj['meeting_id'] = meeting_id
     obj['recording_id'] = files[0]['id']
@@ -168,7 +129,8 @@ def get_meeting_info(client, meeting_id, token):
     if len(transcricao_list) == 0:
         obj['transcription'] = None
     else:
-        obj['transcription'] = f"{transcricao_list[0]['download_url']}?access_token={token}"
+        # Stored without the access token, which expires; see transcripts.download_transcript
+        obj['transcription'] = transcricao_list[0]['download_url']
     obj['psw'] = dados['password']
     obj['meeting_id'] = meeting_id
     obj['recording_id'] = files[0]['id']
@@ -258,6 +220,7 @@ def adicionar_disciplina(nome="Datavis Studio II", zoom_id=91739934274, turma="M
     db.disciplinas.insert_one({"finalizada": False, 'nome': nome,
                                "turma": turma, "zoom_id": zoom_id,
                                "channel": "5-tri-interfaces-narrativas-para-web"})
+    rebuild_static_site()
 
 
 def split_markdown(markdown_str, chunk_size=2000):
@@ -320,6 +283,7 @@ if __name__ == '__main__':
     db = initiate_mongo_db()
     zoom_client = initiate_zoom_app()
     # slack_client = WebClient(token=os.environ.get("SLACK_BOT_TOKEN"))
+    novas_gravacoes = 0
     for x in db.disciplinas.find({"finalizada": False}):
         last = get_meeting_info(zoom_client[0], x['zoom_id'], zoom_client[1])
         if db.gravacoes.find_one({"recording_id": last['recording_id']}):
@@ -327,7 +291,9 @@ if __name__ == '__main__':
             continue
         else:
             print("Acrescentando gravação")
+            novas_gravacoes += 1
             if x['turma'] == 'MJD002':
+                store_transcript(db, last['recording_id'], last['transcription'], zoom_client[1])
                 slack_client = WebClient(
                     token=os.environ.get("SLACK_BOT_TOKEN22"))
                 lp = lista_presenca(zoom_client[0], last['meeting_id'])
@@ -343,6 +309,8 @@ if __name__ == '__main__':
                 db.gravacoes.insert_one(last)
             elif x['turma'] == 'MJD003':
                 print(x)
+                # Downloaded right away, while the token is fresh, and kept for later use
+                transcript = store_transcript(db, last['recording_id'], last['transcription'], zoom_client[1])
                 slack_client = WebClient(
                     token=os.environ.get("SLACK_BOT_TOKEN23"))
                 lp = lista_presenca(zoom_client[0], last['meeting_id'])
@@ -357,22 +325,14 @@ if __name__ == '__main__':
                 last.update(lp)
                 db.gravacoes.insert_one(last)
 
-                if last['transcription']:
+                if transcript:
                     print("Generating AI summary")
-                    client, token, refresh_token = initiate_zoom_app()
-                    new_url = f'{last["transcription"].split("?")[0]}?access_token={token}'
-                    transcript = requests.get(new_url)
-                    text = transcript.text
-                    ai_summary = generate_class_summary(text)
-                    parsed = parse_summary(ai_summary)
-                    final_summary = fix_class_summary(parsed['blocks'], x['nome'])
-                    summary_dict = {
-                        "title": final_summary.parsed.title,
-                        "summary": final_summary.parsed.summary,
-                        "blocks": parsed['blocks']
-                    }
+                    parsed, summary_dict = summarize_transcript(transcript, x['nome'])
                     print("AI summary generated")
-                    db.gravacoes.update_one({"recording_id": last["recording_id"]}, {"$set": {"ai_summary": summary_dict}})
+                    db.gravacoes.update_one({"recording_id": last["recording_id"]}, {"$set": {"ai_summary": summary_dict, "ai_summary_at": datetime.now(timezone.utc)}})
+                    last['ai_summary'] = summary_dict
+                    upsert_class_blocks(get_pinecone_index(INDEX_NAME), last, x)
+                    print(f"Blocks indexed for {x['turma']}")
                     print("Sending summary to slack")
                     if len(parsed['summary']) >= 2500:
                         chunks = split_markdown(parsed['summary'], chunk_size=2000)
@@ -381,5 +341,8 @@ if __name__ == '__main__':
                             time.sleep(2)
                     else:
                         msg_nova_transcricao(parsed['summary'], slack_client, channel=x['channel'])
+    if novas_gravacoes:
+        print("Atualizando páginas estáticas")
+        rebuild_static_site()
     print("Done")
             
\ No newline at end of file
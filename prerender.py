@@ -0,0 +1,109 @@
+import gzip
+import os
+import re
+import shutil
+import subprocess
+import sys
+from starlette.requests import Request
+from starlette.responses import FileResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SITE_DIR = os.environ.get('STATIC_SITE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'site'))
+# Public URL of the site, used for the canonical links of the exported pages
+SITE_URL = os.environ.get('SITE_URL')
+# Requests carrying this header skip the pre-rendered files (used while exporting)
+PRERENDER_HEADER = 'x-prerender'
+PRERENDERED_ROUTES = re.compile(r'^/$|^/courses/\d+$|^/expand/[0-9a-f]{24}$')
+# HTMX fragments, exported as the partial the live route returns to hx-get
+FRAGMENT_ROUTES = re.compile(r'^/expand/')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def page_file(path, site_dir=SITE_DIR):
+    return os.path.join(site_dir, path.strip('/'), 'index.html')
+
+
+def write_file(filename, content):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp = f'{filename}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    os.replace(tmp, filename)
+
+
+def write_page(filename, html):
+    write_file(filename, html)
+    write_file(f'{filename}.gz', gzip.compress(html, compresslevel=9, mtime=0))
+    if brotli:
+        write_file(f'{filename}.br', brotli.compress(html, quality=11))
+
+
+def export_site(app, paths, site_dir=SITE_DIR):
+    """Renders each path through the app and writes it (plus .gz/.br variants) under site_dir."""
+    from starlette.testclient import TestClient
+    if not SITE_URL:
+        raise Exception("SITE_URL not set, it is needed for the canonical links of the exported pages")
+    client = TestClient(app, base_url=SITE_URL)
+    # Built aside and swapped in at the end, so a failed export never leaves a mix of old and new pages
+    build_dir = f'{site_dir}.new'
+    shutil.rmtree(build_dir, ignore_errors=True)
+    for path in paths:
+        headers = {PRERENDER_HEADER: '1'}
+        if FRAGMENT_ROUTES.match(path):
+            headers['HX-Request'] = 'true'
+        response = client.get(path, headers=headers)
+        response.raise_for_status()
+        write_page(page_file(path, build_dir), response.content)
+    old_dir = f'{site_dir}.old'
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(site_dir):
+        os.rename(site_dir, old_dir)
+    os.rename(build_dir, site_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    print(f"{len(paths)} pages exported to {site_dir}")
+
+
+def rebuild_static_site():
+    """Re-exports the pages in a separate process; called by the ingestion scripts."""
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, 'main.py', 'export'], cwd=app_dir)
+    if result.returncode != 0:
+        # The exported pages no longer match the database: drop them so the app renders them live
+        shutil.rmtree(SITE_DIR, ignore_errors=True)
+        print(f"ERROR: static site export failed with exit code {result.returncode}, removed {SITE_DIR}; "
+              "pages are rendered by the app until the next successful export", file=sys.stderr)
+    return result.returncode == 0
+
+
+class PrerenderMiddleware:
+    """Serves pre-rendered pages from site_dir, falling back to the app when there is no file."""
+
+    def __init__(self, app, site_dir=SITE_DIR):
+        self.app = app
+        self.site_dir = site_dir
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+            response = self.prerendered(Request(scope))
+            if response:
+                return await response(scope, receive, send)
+        await self.app(scope, receive, send)
+
+    def prerendered(self, request):
+        if PRERENDER_HEADER in request.headers or not PRERENDERED_ROUTES.match(request.url.path):
+            return None
+        filename = page_file(request.url.path, self.site_dir)
+        if not os.path.exists(filename):
+            return None
+        headers = {'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+        accepted = request.headers.get('accept-encoding', '')
+        for encoding, suffix in ENCODINGS:
+            if encoding in accepted and os.path.exists(filename + suffix):
+                headers['Content-Encoding'] = encoding
+                filename += suffix
+                break
+        return FileResponse(filename, media_type='text/html; charset=utf-8', headers=headers)
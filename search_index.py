@@ -0,0 +1,139 @@
+import bisect
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from unidecode import unidecode
+from timestamps import start_to_ms
+
+REFRESH_INTERVAL = 60
+
+STOPWORDS = {
+    "a", "ao", "aos", "as", "com", "como", "da", "das", "de", "do", "dos", "e", "em", "foi", "na", "nas", "no",
+    "nos", "o", "os", "ou", "para", "pela", "pelo", "por", "que", "qual", "quais", "se", "sobre", "um", "uma",
+    "onde", "quando", "aula", "aulas",
+}
+
+
+def tokenize(text):
+    words = re.findall(r"[a-z0-9]+", unidecode(text.lower()))
+    return [w for w in words if w not in STOPWORDS and len(w) > 1]
+
+
+def recording_link(url, start_ms):
+    if not url:
+        return None
+    return f"{url}{'&' if '?' in url else '?'}startTime={start_ms}"
+
+
+class SearchIndex:
+    """Inverted index over the ai_summary blocks of the recordings."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.postings = defaultdict(dict)
+        self.vocabulary = []
+        self.blocks = []
+        # recording _id -> (ai_summary_at, block ids), to skip or replace already indexed recordings
+        self.recordings = {}
+        self.latest_summary = None
+        # Highest recording _id indexed: ObjectIds grow with insertion time, so newer recordings are above it
+        self.latest_id = None
+        self.refreshed = 0
+
+    def add_recording(self, recording, course):
+        version = recording.get('ai_summary_at')
+        with self.lock:
+            indexed = self.recordings.get(recording['_id'])
+            if indexed and indexed[0] == version:
+                return
+            if indexed:
+                self.remove_blocks(indexed[1])
+            block_ids = []
+            for block in recording['ai_summary']['blocks']:
+                block_id = len(self.blocks)
+                start_ms = start_to_ms(block['start'])
+                self.blocks.append({
+                    'course': course.get('nome', recording['disciplina']),
+                    'turma': course.get('turma'),
+                    'date': recording['data_str'],
+                    'start': block['start'],
+                    'text': block['block'],
+                    'link': recording_link(recording.get('video_url'), start_ms),
+                })
+                for token, count in Counter(tokenize(block['block'])).items():
+                    if token not in self.postings:
+                        bisect.insort(self.vocabulary, token)
+                    self.postings[token][block_id] = count
+                block_ids.append(block_id)
+            self.recordings[recording['_id']] = (version, block_ids)
+            if self.latest_id is None or recording['_id'] > self.latest_id:
+                self.latest_id = recording['_id']
+            if version and (self.latest_summary is None or version > self.latest_summary):
+                self.latest_summary = version
+
+    def remove_blocks(self, block_ids):
+        for block_id in block_ids:
+            for token in set(tokenize(self.blocks[block_id]['text'])):
+                self.postings[token].pop(block_id, None)
+            self.blocks[block_id] = None
+
+    def refresh(self, db, wait=True):
+        """Indexes recordings whose summary was added or rewritten since the last refresh."""
+        if not self.refresh_lock.acquire(blocking=wait):
+            return  # another request is already refreshing
+        try:
+            query = {"ai_summary.blocks": {"$exists": True}}
+            if self.latest_id is not None:
+                # Summaries written after the recording was inserted carry ai_summary_at
+                new_summaries = [{"_id": {"$gt": self.latest_id}}]
+                if self.latest_summary:
+                    new_summaries.append({"ai_summary_at": {"$gt": self.latest_summary}})
+                else:
+                    new_summaries.append({"ai_summary_at": {"$exists": True}})
+                query["$or"] = new_summaries
+            new_recordings = list(db.gravacoes.find(query))
+            if new_recordings:
+                courses = {c['zoom_id']: c for c in db.disciplinas.find({"zoom_id": {"$in": [r['meeting_id'] for r in new_recordings]}})}
+                for recording in new_recordings:
+                    self.add_recording(recording, courses.get(recording['meeting_id'], {}))
+                print(f"Search index: {len(new_recordings)} recordings (re)indexed")
+            self.refreshed = time.time()
+        finally:
+            self.refresh_lock.release()
+
+    def maybe_refresh(self, db, interval=REFRESH_INTERVAL):
+        if time.time() - self.refreshed > interval:
+            self.refresh(db, wait=False)
+
+    def expand(self, term):
+        # Last term of an as-you-type query matches as a prefix
+        start = bisect.bisect_left(self.vocabulary, term)
+        end = bisect.bisect_left(self.vocabulary, term + "￿")
+        return self.vocabulary[start:end]
+
+    def search(self, query, limit=10, turma=None):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        prefix = not query[-1:].isspace()
+        with self.lock:
+            total = sum(1 for block in self.blocks if block)
+            scores = defaultdict(float)
+            matched = Counter()
+            for i, term in enumerate(terms):
+                tokens = self.expand(term) if prefix and i == len(terms) - 1 else [term]
+                term_scores = {}
+                for token in tokens:
+                    postings = self.postings.get(token, {})
+                    idf = math.log(1 + total / len(postings)) if postings else 0
+                    for block_id, count in postings.items():
+                        term_scores[block_id] = max(term_scores.get(block_id, 0), (1 + math.log(count)) * idf)
+                for block_id, score in term_scores.items():
+                    scores[block_id] += score
+                    matched[block_id] += 1
+            ranked = sorted(scores, key=lambda b: (matched[b], scores[b]), reverse=True)
+            hits = [self.blocks[b] for b in ranked if turma is None or self.blocks[b]['turma'] == turma]
+        return hits[:limit]
@@ -0,0 +1,76 @@
+from datetime import datetime, timezone
+from typing import List
+import ell
+from pydantic import BaseModel, Field
+from prerender import rebuild_static_site
+from ai_helpers import INDEX_NAME, get_pinecone_index, upsert_class_blocks
+from transcripts import load_transcript, transcript_text
+
+
+class Block(BaseModel):
+    block: str = Field(description="Os temas e conceitos que foram abordados neste trecho da aula, em bullet points. Seja específico sobre todos os conceitos e conteúdos.")
+    start: str = Field(description="O tempo de início deste trecho no formato HH:MM:SS.MS")
+
+
+class Summary(BaseModel):
+    summary: str = Field(description="Um resumo em um parágrafo sobre o que foi abordado na aula")
+    blocks: List[Block] = Field(description="Uma lista de trechos da aula, cada um com os assuntos abordados, e o tempo correspondente no vídeo. O foco deve ser exclusivamente o conteúdo da aula, e não na descrição do que aconteceu.")
+    
+    
+class FinalSummary(BaseModel):
+    summary: str = Field(description="Um resumo em um parágrafo sobre o que foi abordado na aula")
+    title: str = Field(description="Um título para a aula, com breve lista de conceitos mais importantesentre parênteses")
+
+    
+
+@ell.complex(model="gpt-4o", response_format=FinalSummary)
+def fix_class_summary(blocks: List[Block], disciplina: str) -> FinalSummary:
+    """Você é um professor assistente que recebe um resumo estruturado de uma aula e corrige possíveis erros de formatação, sem alterar o conteúdo."""
+    return f"Leia a seguinte lista de trechos de uma aula da disciplina {disciplina}. Crie um título para a aula, dentro do contexto da disciplina, e um resumo em um parágrafo sobre o que foi abordado: {blocks}"
+
+
+@ell.complex(model="gpt-4o-mini", response_format=Summary)
+def generate_class_summary(transcription: str) -> Summary:
+    """Você é um professor assistente que recebe a transcrição de uma aula e gera um resumo estruturado com o conteúdo abordado."""
+    return f"Gere um resumo da seguinte aula: {transcription}"
+
+
+def parse_summary(summary):
+    data = {}
+    parsed = summary.content[0].parsed
+    data['summary'] = parsed.summary
+    data['blocks'] = []
+    for block in parsed.blocks:
+        data['blocks'].append({
+            'block': block.block,
+            'start': block.start
+        })
+    return data
+
+
+def summarize_transcript(transcript, disciplina):
+    ai_summary = generate_class_summary(transcript_text(transcript))
+    parsed = parse_summary(ai_summary)
+    final_summary = fix_class_summary(parsed['blocks'], disciplina)
+    summary_dict = {
+        "title": final_summary.parsed.title,
+        "summary": final_summary.parsed.summary,
+        "blocks": parsed['blocks']
+    }
+    return parsed, summary_dict
+
+
+def resummarize_recording(db, recording_id, disciplina=None):
+    """Regenerates the AI summary from the stored transcript, without calling Zoom."""
+    transcript = load_transcript(db, recording_id)
+    if transcript is None:
+        print("Transcrição não encontrada")
+        return None
+    recording = db.gravacoes.find_one({"recording_id": recording_id})
+    course = db.disciplinas.find_one({"zoom_id": recording['meeting_id']})
+    parsed, summary_dict = summarize_transcript(transcript, disciplina or course['nome'])
+    db.gravacoes.update_one({"recording_id": recording_id}, {"$set": {"ai_summary": summary_dict, "ai_summary_at": datetime.now(timezone.utc)}})
+    recording['ai_summary'] = summary_dict
+    upsert_class_blocks(get_pinecone_index(INDEX_NAME), recording, course)
+    rebuild_static_site()
+    return summary_dict
@@ -0,0 +1,14 @@
+def start_to_ms(start):
+    """Converts a timestamp like 'HH:MM:SS.MS' (or 'MM:SS') to milliseconds."""
+    try:
+        seconds = 0.0
+        for part in start.strip().split(":"):
+            seconds = seconds * 60 + float(part)
+        return int(seconds * 1000)
+    except (AttributeError, ValueError):
+        return 0
+
+
+def ms_to_timestamp(ms):
+    seconds = ms // 1000
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
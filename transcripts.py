@@ -0,0 +1,76 @@
+import bisect
+import gzip
+import json
+import re
+import gridfs
+import requests
+from timestamps import start_to_ms, ms_to_timestamp
+
+TRANSCRIPTS_COLLECTION = 'transcricoes'
+CUE_TIME = re.compile(r'^((?:\d+:)?\d{2}:\d{2}[.,]\d{3})\s+-->')
+
+
+def download_transcript(url, token):
+    # The token goes in the header so it never ends up stored next to the URL
+    response = requests.get(url, headers={"Authorization": f"Bearer {token}"})
+    response.raise_for_status()
+    return response.text
+
+
+def parse_vtt(vtt):
+    """Parses a WebVTT file into parallel lists of cue start times (ms) and texts."""
+    transcript = {'starts': [], 'texts': []}
+    lines = []
+    for line in vtt.splitlines() + ['']:
+        line = line.strip()
+        match = CUE_TIME.match(line)
+        if match:
+            transcript['starts'].append(start_to_ms(match.group(1).replace(',', '.')))
+            lines = []
+        elif line and transcript['starts'] and len(transcript['texts']) < len(transcript['starts']) and not line.isdigit():
+            lines.append(line)
+        elif not line and len(transcript['texts']) < len(transcript['starts']):
+            transcript['texts'].append(' '.join(lines))
+    return transcript
+
+
+def transcript_text(transcript):
+    """Compact 'HH:MM:SS text' lines, much shorter than the raw VTT for the LLM."""
+    return '\n'.join(f"{ms_to_timestamp(start)} {text}" for start, text in zip(transcript['starts'], transcript['texts']))
+
+
+def save_transcript(db, recording_id, transcript):
+    fs = gridfs.GridFS(db, collection=TRANSCRIPTS_COLLECTION)
+    for old in fs.find({"recording_id": recording_id}):
+        fs.delete(old._id)
+    data = gzip.compress(json.dumps(transcript, separators=(',', ':')).encode())
+    return fs.put(data, filename=f"{recording_id}.json.gz", recording_id=recording_id)
+
+
+def store_transcript(db, recording_id, url, token):
+    """Downloads, parses and saves a recording's transcript. Returns None if there is none or the download fails."""
+    if not url:
+        return None
+    try:
+        transcript = parse_vtt(download_transcript(url, token))
+    except requests.RequestException as e:
+        print(f"Não foi possível baixar a transcrição da gravação {recording_id}: {e}")
+        return None
+    save_transcript(db, recording_id, transcript)
+    return transcript
+
+
+def load_transcript(db, recording_id):
+    fs = gridfs.GridFS(db, collection=TRANSCRIPTS_COLLECTION)
+    stored = fs.find_one({"recording_id": recording_id})
+    if stored is None:
+        return None
+    return json.loads(gzip.decompress(stored.read()))
+
+
+def said_at(transcript, timestamp, context=2):
+    """Returns the cues around the given 'HH:MM:SS' as (start ms, text) pairs."""
+    i = bisect.bisect_right(transcript['starts'], start_to_ms(timestamp)) - 1
+    first = max(0, i - context)
+    last = min(len(transcript['starts']), max(i, 0) + context + 1)
+    return list(zip(transcript['starts'][first:last], transcript['texts'][first:last]))